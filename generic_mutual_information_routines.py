@@ -6,6 +6,7 @@ Created on Wed May  3 13:49:29 2023
 """
 
 import aaft
+import concurrent.futures
 import scipy
 
 import matplotlib.pyplot as plt
@@ -13,9 +14,23 @@ import numpy as np
 import pandas as pd
 import datetime as dt
 
+from joblib import Parallel, delayed
+from numpy.lib.stride_tricks import sliding_window_view
 from sklearn.feature_selection import mutual_info_regression
+from sklearn.metrics import mutual_info_score
+from sklearn.neighbors import KDTree, NearestNeighbors
 from scipy.optimize import curve_fit
+from scipy.special import digamma
 from scipy import stats
+
+try:
+    from numba import njit, prange
+    numba_available=True
+except ImportError:
+    numba_available=False
+
+# Maximum number of distinct values per timeseries for the contingency MI
+max_contingency_levels=256
  
 def test_mi_lag_finder(check_surrogate=False):
     """
@@ -124,6 +139,76 @@ def test_effect_of_data_gaps():
 
     return
 
+def test_mi_estimators():
+    """
+    Run this to check the MI estimators of mi_across_lags against each
+    other and against sklearn
+    
+    Parameters
+    ----------
+
+        
+    Returns
+    -------
+    Prints each check as it passes, raises an AssertionError if one fails.
+    """
+
+    rng=np.random.default_rng(0)
+
+    # Short continuous data, b lagging a by 5: every value is distinct, so
+    #   'auto' must use the kNN estimator rather than a contingency table
+    x=rng.normal(size=240)
+    y=np.roll(x,5)+0.3*rng.normal(size=240)
+    timeseries_a, lagged_timeseries_b, lags=lag_data(x, y, max_lag=10, min_lag=-10)
+    knn_mi=mi_across_lags(lagged_timeseries_b, timeseries_a, estimator='knn')
+    auto_mi=mi_across_lags(lagged_timeseries_b, timeseries_a, estimator='auto')
+    assert lags[knn_mi.argmax()]==5, 'knn estimator does not find the lag of 5'
+    assert np.allclose(auto_mi, knn_mi), 'auto estimator did not use knn for continuous data'
+    print('PASS: auto uses knn for short continuous data')
+    sklearn_mi=mutual_info_regression(lagged_timeseries_b, timeseries_a, random_state=0)
+    assert np.allclose(knn_mi, sklearn_mi, atol=1e-6), 'knn MI does not match sklearn mutual_info_regression'
+    print('PASS: knn matches sklearn')
+
+    # Discrete data with few levels, b lagging a by 5
+    x=rng.integers(0,6,2000)
+    y=np.roll(x,5)+rng.integers(0,2,2000)
+    timeseries_a, lagged_timeseries_b, lags=lag_data(x, y, max_lag=10, min_lag=-10)
+    sklearn_mi=np.array([mutual_info_score(timeseries_a, lagged_timeseries_b[:,i].astype(int)) for i in range(lags.size)])
+    contingency_mi=mi_across_lags(lagged_timeseries_b, timeseries_a, estimator='contingency')
+    auto_mi=mi_across_lags(lagged_timeseries_b, timeseries_a, estimator='auto')
+    histogram_mi=mi_across_lags(lagged_timeseries_b, timeseries_a, estimator='histogram')
+    assert np.allclose(contingency_mi, sklearn_mi), 'contingency MI does not match sklearn mutual_info_score'
+    assert np.allclose(auto_mi, contingency_mi), 'auto estimator did not use contingency for discrete data'
+    assert lags[histogram_mi.argmax()]==5, 'histogram estimator does not find the lag of 5'
+    print('PASS: contingency matches sklearn, auto uses it for discrete data')
+    print('PASS: histogram finds the lag')
+
+    # A subset of lags, as used for the surrogate MI, binned on the range
+    #   of all the lags matches the MI at those lags. b has an outlier
+    #   outside the lag 0 window, so the lag 0 range is narrower
+    x=rng.normal(size=2000)
+    y=np.roll(x,5)+0.3*rng.normal(size=2000)
+    y[0]=20.0
+    timeseries_a, lagged_timeseries_b, lags=lag_data(x, y, max_lag=10, min_lag=-10)
+    span_b=lagged_span(lagged_timeseries_b)
+    zero_i=np.abs(lags).argmin()
+    histogram_mi=histogram_mi_across_lags(lagged_timeseries_b, timeseries_a)
+    zero_mi=histogram_mi_across_lags(lagged_timeseries_b[:,zero_i:zero_i+1], timeseries_a,
+                                     b_range=(np.min(span_b), np.max(span_b)))
+    assert np.isclose(zero_mi[0], histogram_mi[zero_i]), 'histogram MI of one lag is not binned as for all lags'
+    print('PASS: histogram bins a subset of lags as for all lags')
+
+    # Continuous data has too many levels for the contingency estimator
+    x=rng.normal(size=2000)
+    timeseries_a, lagged_timeseries_b, lags=lag_data(x, np.roll(x,5), max_lag=10, min_lag=-10)
+    try:
+        mi_across_lags(lagged_timeseries_b, timeseries_a, estimator='contingency')
+        raise AssertionError('contingency estimator accepted continuous data')
+    except NameError:
+        print('PASS: contingency refuses continuous data')
+
+    return
+
 def lag_data(timeseries_a, timeseries_b, temporal_resolution=1, max_lag=60, min_lag=-60):
     """
 
@@ -136,18 +221,22 @@ def lag_data(timeseries_a, timeseries_b, temporal_resolution=1, max_lag=60, min_
     temporal_resolution : integer, optional
         temporal resolution of the data in minutes. The default is 1.
     max_lag : integer, optional
-        maximum lag to shift data by in minutes. The default is 60.
+        maximum lag to shift data by in minutes. Must be a multiple of
+        temporal_resolution. The default is 60.
     min_lag : integer, optional
-        minimum lag to shift data by in minutes. The default is -60.
+        minimum lag to shift data by in minutes. Must be a multiple of
+        temporal_resolution. The default is -60.
 
     Returns
     -------
     timeseries_a : np.array
         unlagged timeseries_a, trimmed to length (i.e. minus the buffer) enabling shifting of timeseries_b.
     lagged_timeseries_b : np.array (2d)
-        lagged timeseries_b, length of timeseries_a x length of lags.
+        lagged timeseries_b, length of timeseries_a x length of lags. This
+        is a read only view onto timeseries_b.
     lags : np.array
-        lags in minutes.
+        lags in minutes, from min_lag to max_lag inclusive in steps of
+        temporal_resolution.
 
     """
     
@@ -155,32 +244,436 @@ def lag_data(timeseries_a, timeseries_b, temporal_resolution=1, max_lag=60, min_
     print('-------------------------')
     print('FUNCTION: lag_data')
     
-    # Define array of lags    
-    lags=np.linspace(min_lag,max_lag,int((max_lag-min_lag)/temporal_resolution)+1).astype(int)
+    # Each lag must be a whole number of samples
+    if (min_lag % temporal_resolution != 0) or (max_lag % temporal_resolution != 0):
+        print('ERROR: lag_data')
+        print('min_lag and max_lag must be multiples of temporal_resolution')
+        print('Exiting...')
+        raise NameError('min_lag and max_lag must be multiples of temporal_resolution')
+
+    # Define array of lags. As both ends are multiples of the step, this
+    #   includes max_lag
+    lags=np.arange(min_lag, max_lag+1, temporal_resolution, dtype=np.intp)
       
     # Define the boundaries of the data - index if lag=0
     length=timeseries_b.size
     start_i=int(abs(min_lag/temporal_resolution))
     end_i=length-int(abs(max_lag/temporal_resolution))
       
-    # Define empty array to put lagged timeseries b in    
-    lagged_timeseries_b=np.full((end_i-start_i, lags.size), np.nan)
-
-    # Fill up this array with lagged data
+    # Lag timeseries b. Row j of the sliding window view is timeseries_b
+    #   starting at index j, so consecutive lags are consecutive rows and
+    #   the lagged array is a (read only) view onto timeseries_b, no copy.
+    #   With timeseries_b contiguous, each lag column is a contiguous
+    #   block of memory, as consumed by the kNN MI estimator
     print('Lagging timeseries_b')
-    for i in range(lags.size):
-        lagged_timeseries_b[:,i]=timeseries_b[start_i+int(lags[i]/temporal_resolution):end_i+int(lags[i]/temporal_resolution)]
+    timeseries_b=np.ascontiguousarray(timeseries_b, dtype=float)
+    windowed_timeseries_b=sliding_window_view(timeseries_b, end_i-start_i)
+    first_i=start_i+int(lags[0]/temporal_resolution)
+    lagged_timeseries_b=windowed_timeseries_b[first_i:first_i+lags.size].T
 
     # Chop off the ends of timeseries a so it's the same length as b
     print('Trimming timeseries_a')
-    timeseries_a=timeseries_a[start_i:end_i]
+    timeseries_a=np.asarray(timeseries_a)[start_i:end_i]
     
     print('-------------------------')
     return timeseries_a, lagged_timeseries_b, lags
 
+def mi_across_lags(lagged_timeseries_b, timeseries_a, n_jobs=-1, estimator='knn', b_range=None):
+    """
+    Calculate the MI between timeseries_a and each lag column of
+    lagged_timeseries_b, with the chosen estimator.
+
+    Parameters
+    ----------
+    lagged_timeseries_b : np.array (2d)
+        lagged timeseries_b, length of timeseries_a x length of lags.
+    timeseries_a : np.array
+        timeseries to be kept stationary, the target of the MI estimation.
+    n_jobs : integer, optional
+        number of threads to run the lag columns over for the kNN
+        estimator. -1 uses all available cores. The default is -1.
+    estimator : string, optional
+        'knn' uses knn_mi_across_lags, the kNN estimator of sklearn
+        mutual_info_regression.
+        'histogram' uses histogram_mi_across_lags, which is much faster
+        but is a coarser estimate of the MI.
+        'contingency' uses contingency_mi_across_lags, the exact MI of
+        data which take a small number of distinct values.
+        'auto' uses the estimator chosen by resolve_estimator. The
+        default is 'knn'.
+    b_range : tuple, optional
+        (min, max) of timeseries_b, parsed to histogram_mi_across_lags.
+        The default is None.
+
+    Returns
+    -------
+    mutual_information : np.array
+        MI between timeseries_a and lagged_timeseries_b at each lag (nats).
+
+    """
+
+    estimator=resolve_estimator(lagged_timeseries_b, timeseries_a, estimator)
+
+    if estimator=='histogram':
+        return histogram_mi_across_lags(lagged_timeseries_b, timeseries_a, b_range=b_range)
+
+    elif estimator=='contingency':
+        return contingency_mi_across_lags(lagged_timeseries_b, timeseries_a)
+
+    elif estimator!='knn':
+        print('ERROR: mi_across_lags')
+        print('estimator must be one of knn, histogram, contingency or auto')
+        print('Exiting...')
+        raise NameError('estimator='+str(estimator)+' not recognised')
+
+    return knn_mi_across_lags(lagged_timeseries_b, timeseries_a, n_jobs=n_jobs)
+
+def resolve_estimator(lagged_timeseries_b, timeseries_a, estimator):
+    """
+    Choose the MI estimator to use for estimator='auto'. Any other
+    estimator is returned unchanged.
+
+    Parameters
+    ----------
+    lagged_timeseries_b : np.array (2d)
+        lagged timeseries_b as returned by lag_data, length of
+        timeseries_a x length of lags. Parse all the lags, so the same
+        estimator is used for every subset of lags.
+    timeseries_a : np.array
+        timeseries to be kept stationary.
+    estimator : string
+        'knn', 'histogram', 'contingency' or 'auto'.
+
+    Returns
+    -------
+    estimator : string
+        'contingency' if estimator='auto' and both timeseries have at most
+        max_contingency_levels distinct values, with at least 10 samples per
+        cell of their contingency table. 'knn' if estimator='auto'
+        otherwise. Else estimator.
+
+    """
+
+    if estimator!='auto':
+        return estimator
+
+    # Low cardinality data have an exact MI from their contingency
+    #   table, which needs no neighbour searches. This is only a good
+    #   estimate if the table is well sampled, so require on average 10
+    #   samples per cell. Continuous data, where every value is its own
+    #   level, then use the kNN estimator
+    a_codes, lagged_b_codes, n_levels_a, n_levels_b=level_codes(lagged_timeseries_b, timeseries_a)
+    if ((n_levels_a<=max_contingency_levels) and (n_levels_b<=max_contingency_levels)
+            and (10*n_levels_a*n_levels_b<=timeseries_a.size)):
+        return 'contingency'
+    else:
+        return 'knn'
+
+def knn_mi_across_lags(lagged_timeseries_b, timeseries_a, n_neighbors=3, n_jobs=-1, random_state=0):
+    """
+    Calculate the MI between timeseries_a and each lag column of
+    lagged_timeseries_b with the kNN estimator of Kraskov et al. (2004),
+    following sklearn mutual_info_regression. timeseries_a is the same for
+    every lag, so its KDTree is built once and shared by all lags, which
+    are spread over threads with joblib.
+
+    Parameters
+    ----------
+    lagged_timeseries_b : np.array (2d)
+        lagged timeseries_b, length of timeseries_a x length of lags.
+    timeseries_a : np.array
+        timeseries to be kept stationary, the target of the MI estimation.
+    n_neighbors : integer, optional
+        number of neighbours used in the MI estimation. The default is 3.
+    n_jobs : integer, optional
+        number of threads to run the lag columns over. -1 uses all
+        available cores. The default is -1.
+    random_state : integer, optional
+        seed for the small noise added to the data to break ties. The
+        default is 0.
+
+    Returns
+    -------
+    mutual_information : np.array
+        MI between timeseries_a and lagged_timeseries_b at each lag (nats).
+
+    """
+
+    timeseries_a=np.asarray(timeseries_a, dtype=float)
+    n=timeseries_a.size
+
+    # Scale a to unit variance and add a small noise, as in sklearn,
+    #   then build the tree on a once
+    a=scale_and_jitter(timeseries_a, np.random.RandomState(random_state)).reshape(-1,1)
+    a_tree=KDTree(a, metric='chebyshev')
+
+    def lag_mi(i):
+        b=scale_and_jitter(lagged_timeseries_b[:,i], np.random.RandomState([random_state, i])).reshape(-1,1)
+
+        # Distance to the kth neighbour in the joint space
+        nn=NearestNeighbors(metric='chebyshev', n_neighbors=n_neighbors)
+        nn.fit(np.hstack((b, a)))
+        radius=np.nextafter(nn.kneighbors()[0][:,-1], 0)
+
+        # Number of points within that distance in each marginal space
+        n_b=KDTree(b, metric='chebyshev').query_radius(b, radius, count_only=True, return_distance=False)-1.0
+        n_a=a_tree.query_radius(a, radius, count_only=True, return_distance=False)-1.0
+
+        mi=digamma(n)+digamma(n_neighbors)-np.mean(digamma(n_b+1))-np.mean(digamma(n_a+1))
+        return max(0, mi)
+
+    mutual_information=Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(lag_mi)(i) for i in range(lagged_timeseries_b.shape[1]))
+
+    return np.array(mutual_information)
+
+def scale_and_jitter(timeseries, rng):
+    """
+    Scale a timeseries to unit variance and add a small gaussian noise to
+    break ties, as sklearn mutual_info_regression does before estimating
+    the MI.
+
+    Parameters
+    ----------
+    timeseries : np.array
+        timeseries to be prepared for the kNN MI estimation.
+    rng : np.random.RandomState
+        random number generator for the noise.
+
+    Returns
+    -------
+    timeseries : np.array
+        scaled copy of timeseries with noise added.
+
+    """
+
+    stdev=np.std(timeseries)
+    if stdev>0:
+        timeseries=timeseries/stdev
+    else:
+        timeseries=timeseries.astype(float)
+    timeseries+=1e-10*np.maximum(1, np.mean(np.abs(timeseries)))*rng.standard_normal(size=timeseries.size)
+
+    return timeseries
+
+def histogram_mi_across_lags(lagged_timeseries_b, timeseries_a, n_bins=None, b_range=None):
+    """
+    Calculate the MI between timeseries_a and each lag column of
+    lagged_timeseries_b by binning both into uniform bins and summing
+    over the joint histogram at each lag.
+
+    Parameters
+    ----------
+    lagged_timeseries_b : np.array (2d)
+        lagged timeseries_b as returned by lag_data, length of
+        timeseries_a x length of lags.
+    timeseries_a : np.array
+        timeseries to be kept stationary.
+    n_bins : integer, optional
+        number of uniform bins to split each timeseries into. The default
+        is None, in which case sqrt(length of timeseries_a) is used.
+    b_range : tuple, optional
+        (min, max) of timeseries_b, the range split into bins. Parse this
+        to bin a subset of lags on the same bins as all the lags. The
+        default is None, in which case the range of lagged_timeseries_b
+        is used.
+
+    Returns
+    -------
+    mutual_information : np.array
+        MI between timeseries_a and lagged_timeseries_b at each lag (nats).
+
+    """
+
+    if n_bins is None:
+        n_bins=int(np.sqrt(timeseries_a.size))
+
+    # Digitize each timeseries into n_bins uniform bins, numbered 0 to n_bins-1.
+    #   b is digitized once from the 1D timeseries spanned by the lags, with
+    #   one set of bins for all lags. The binned lags are a sliding window
+    #   view onto that, so each lag is a contiguous block of memory
+    a_edges=np.linspace(np.min(timeseries_a), np.max(timeseries_a), n_bins+1)
+    a_bins=np.digitize(timeseries_a, a_edges[1:-1])
+    span_b=lagged_span(lagged_timeseries_b)
+    if b_range is None:
+        b_range=(np.min(span_b), np.max(span_b))
+    b_edges=np.linspace(b_range[0], b_range[1], n_bins+1)
+    lagged_b_bins=sliding_window_view(np.digitize(span_b, b_edges[1:-1]), lagged_timeseries_b.shape[0]).T
+
+    return binned_mi_across_lags(a_bins, lagged_b_bins, n_bins, n_bins)
+
+def contingency_mi_across_lags(lagged_timeseries_b, timeseries_a):
+    """
+    Calculate the MI between timeseries_a and each lag column of
+    lagged_timeseries_b from their contingency table, treating each
+    distinct value as a category. This is exact for data which take a
+    small number of distinct values, e.g. quantised or flagged data.
+
+    Parameters
+    ----------
+    lagged_timeseries_b : np.array (2d)
+        lagged timeseries_b as returned by lag_data, length of
+        timeseries_a x length of lags.
+    timeseries_a : np.array
+        timeseries to be kept stationary.
+
+    Returns
+    -------
+    mutual_information : np.array
+        MI between timeseries_a and lagged_timeseries_b at each lag (nats).
+
+    """
+
+    a_codes, lagged_b_codes, n_levels_a, n_levels_b=level_codes(lagged_timeseries_b, timeseries_a)
+
+    # The joint table has n_levels_a x n_levels_b cells per lag, which is
+    #   too large for continuous data
+    if (n_levels_a>max_contingency_levels) or (n_levels_b>max_contingency_levels):
+        print('ERROR: contingency_mi_across_lags')
+        print('timeseries_a has '+str(n_levels_a)+' and timeseries_b has '+str(n_levels_b)+' distinct values,')
+        print('    the contingency estimator allows at most '+str(max_contingency_levels)+'. Use the')
+        print('    knn or histogram estimator for continuous data.')
+        print('Exiting...')
+        raise NameError('too many distinct values for the contingency estimator')
+
+    return binned_mi_across_lags(a_codes, lagged_b_codes, n_levels_a, n_levels_b)
+
+def level_codes(lagged_timeseries_b, timeseries_a):
+    """
+    Number the distinct values of timeseries_a and lagged_timeseries_b
+    0 to n_levels-1. Consecutive lags of lagged_timeseries_b are one sample
+    apart, so b is numbered once from the 1D timeseries spanned by the lags,
+    and the numbered lags are a sliding window view onto that.
+
+    Parameters
+    ----------
+    lagged_timeseries_b : np.array (2d)
+        lagged timeseries_b as returned by lag_data, length of
+        timeseries_a x length of lags.
+    timeseries_a : np.array
+        timeseries to be kept stationary.
+
+    Returns
+    -------
+    a_codes : np.array of integers
+        number of the distinct value of each value of timeseries_a.
+    lagged_b_codes : np.array of integers (2d)
+        number of the distinct value of each value of lagged_timeseries_b.
+    n_levels_a : integer
+        number of distinct values of timeseries_a.
+    n_levels_b : integer
+        number of distinct values of lagged_timeseries_b.
+
+    """
+
+    a_levels,a_codes=np.unique(timeseries_a, return_inverse=True)
+    a_codes=a_codes.reshape(-1).astype(np.int32)
+
+    span_b=lagged_span(lagged_timeseries_b)
+    b_levels,b_codes=np.unique(span_b, return_inverse=True)
+    lagged_b_codes=sliding_window_view(b_codes.reshape(-1).astype(np.int32), lagged_timeseries_b.shape[0]).T
+
+    return a_codes, lagged_b_codes, a_levels.size, b_levels.size
+
+def lagged_span(lagged_timeseries_b):
+    """
+    Recover the 1D timeseries_b spanned by the lags of lagged_timeseries_b,
+    so it can be binned once rather than once per lag.
+
+    Parameters
+    ----------
+    lagged_timeseries_b : np.array (2d)
+        lagged timeseries_b as returned by lag_data, length of
+        timeseries_a x length of lags, with consecutive lags one sample
+        apart.
+
+    Returns
+    -------
+    span_b : np.array
+        timeseries_b from the start of the first lag to the end of the
+        last lag.
+
+    """
+
+    # The span is the first lag followed by the last sample of each
+    #   later lag
+    span_b=np.concatenate((lagged_timeseries_b[:,0], lagged_timeseries_b[-1,1:]))
+    if not np.array_equal(span_b[-lagged_timeseries_b.shape[0]:], lagged_timeseries_b[:,-1]):
+        print('ERROR: lagged_span')
+        print('lagged_timeseries_b must be as returned by lag_data, with consecutive')
+        print('    lags one sample apart')
+        print('Exiting...')
+        raise NameError('lagged_timeseries_b lags are not one sample apart')
+
+    return span_b
+
+def binned_mi_across_lags(a_bins, lagged_b_bins, n_bins_a, n_bins_b):
+    """
+    Calculate the MI between binned timeseries_a and each lag column of
+    binned lagged_timeseries_b from their joint histogram. Uses a numba
+    kernel parallelised over lags if numba is installed.
+
+    Parameters
+    ----------
+    a_bins : np.array of integers
+        bin number (0 to n_bins_a-1) of each value of timeseries_a.
+    lagged_b_bins : np.array of integers (2d)
+        bin number (0 to n_bins_b-1) of each value of lagged_timeseries_b.
+    n_bins_a : integer
+        number of bins for timeseries_a.
+    n_bins_b : integer
+        number of bins for lagged_timeseries_b.
+
+    Returns
+    -------
+    mutual_information : np.array
+        MI between timeseries_a and lagged_timeseries_b at each lag (nats).
+
+    """
+
+    mutual_information=np.zeros(lagged_b_bins.shape[1])
+
+    if numba_available:
+        _binned_mi_kernel(a_bins, lagged_b_bins, n_bins_a, n_bins_b, mutual_information)
+        return mutual_information
+
+    n=a_bins.size
+    for i in range(lagged_b_bins.shape[1]):
+        joint=np.bincount(a_bins.astype(np.int64)*n_bins_b+lagged_b_bins[:,i], minlength=n_bins_a*n_bins_b).reshape(n_bins_a, n_bins_b)
+        p_a=joint.sum(axis=1)
+        p_b=joint.sum(axis=0)
+        a_ind,b_ind=np.nonzero(joint)
+        p_ab=joint[a_ind,b_ind]/n
+        mutual_information[i]=np.sum(p_ab*np.log(p_ab*n*n/(p_a[a_ind]*p_b[b_ind])))
+
+    return mutual_information
+
+if numba_available:
+    @njit(parallel=True, cache=True)
+    def _binned_mi_kernel(a_bins, lagged_b_bins, n_bins_a, n_bins_b, out):
+        # Fill the joint histogram for each lag in parallel, then sum
+        #   p_ab*log(p_ab/(p_a*p_b)) over the occupied bins
+        n=a_bins.size
+        for j in prange(lagged_b_bins.shape[1]):
+            joint=np.zeros((n_bins_a, n_bins_b), np.int64)
+            for i in range(n):
+                joint[a_bins[i], lagged_b_bins[i,j]]+=1
+            p_a=np.zeros(n_bins_a, np.int64)
+            p_b=np.zeros(n_bins_b, np.int64)
+            for k in range(n_bins_a):
+                for m in range(n_bins_b):
+                    p_a[k]+=joint[k,m]
+                    p_b[m]+=joint[k,m]
+            mi=0.0
+            for k in range(n_bins_a):
+                for m in range(n_bins_b):
+                    if joint[k,m]>0:
+                        mi+=(joint[k,m]/n)*np.log(joint[k,m]*n/(p_a[k]*p_b[m]))
+            out[j]=mi
+
 def mi_lag_finder(timeseries_a, timeseries_b, temporal_resolution=1, max_lag=60, min_lag=-60, check_surrogate=False,
                   csize=15, no_plot=False,
-                  remove_nan_rows=False):
+                  remove_nan_rows=False, n_jobs=-1, n_surrogates=20, estimator='knn'):
     """
 
     Parameters
@@ -190,9 +683,9 @@ def mi_lag_finder(timeseries_a, timeseries_b, temporal_resolution=1, max_lag=60,
     temporal_resolution : int
         temporal resolution in minutes. If not in minutes please interpolate first!
     max_lag : default = 60 minutes
-        maximum lag for xaxis in minutes
+        maximum lag for xaxis in minutes. Must be a multiple of temporal_resolution
     min_lag : default = 60 minutes
-        minimum lag for xaxis in minutes
+        minimum lag for xaxis in minutes. Must be a multiple of temporal_resolution
     check_surrogate : bool, default=False
         If True, plots the surrogate MI info, if False draws an arrow indicating
         the mean surrogate MI. The default is False.
@@ -204,13 +697,30 @@ def mi_lag_finder(timeseries_a, timeseries_b, temporal_resolution=1, max_lag=60,
         If True, rows with np.nan from either timeseries_a or timeseries_b are removed from
         both timeseries. If False, and data are parsed with np.nan, program will exit.
         THIS IS CURRENTLY BEING TESTED TO SEE HOW THE SCIENCE RESULTS ARE AFFECTED.
+    n_jobs : int, default=-1
+        number of threads used to calculate the MI across lags. -1 uses all
+        available cores.
+    n_surrogates : int or None, default=20
+        If check_surrogate == False, only the mean surrogate MI is used, so it
+        is estimated from n_surrogates random phase surrogates of timeseries_a
+        at the lag nearest zero, and RPS_mutual_information is this mean at
+        every lag. If None, the surrogate MI is calculated at every lag as for
+        check_surrogate == True.
+    estimator : str, default='knn'
+        MI estimator parsed to mi_across_lags. 'knn' uses the kNN estimator
+        of sklearn mutual_info_regression. 'histogram' uses a much faster
+        estimate from the joint histogram of uniformly binned data, using
+        numba if installed. 'contingency' uses the exact MI of data with few
+        distinct values, and 'auto' picks 'contingency' for data with few
+        distinct values relative to the number of samples, otherwise 'knn'.
 
     Returns
     -------
     ax : axes object
     lags : array of the xaxis lags (minutes)
     mutual_information : array of the yaxis mutual information (bits)
-    RPS_mutual_information : array of the yaxis mutual information between b and an random phase surrogate of a (bits)
+    RPS_mutual_information : array of the yaxis mutual information between b and an random phase surrogate of a (bits).
+        If check_surrogate == False and n_surrogates is not None, this is the mean surrogate MI at every lag
     x_squared_df : pandas DataFrame containing fitting information on x-squared fit
     x_piecewise_df : pandas DataFrame containing fitting information on piecewise linear fit
     """
@@ -224,7 +734,7 @@ def mi_lag_finder(timeseries_a, timeseries_b, temporal_resolution=1, max_lag=60,
         print('Exiting...')
         raise NameError('timeseries_a and timeseries_b must have same length')
         
-    if (np.isnan(np.sum(timeseries_a)) | np.isnan(np.sum(timeseries_b))) & (remove_nan_rows == False):
+    if (remove_nan_rows == False) and (np.isnan(timeseries_a).any() or np.isnan(timeseries_b).any()):
         print('ERROR: mi_lag_finder')
         print('Input data contains np.nan values, please deal with missing data before')
         print('    running this program or call flag remove_nan_rows.')
@@ -233,27 +743,48 @@ def mi_lag_finder(timeseries_a, timeseries_b, temporal_resolution=1, max_lag=60,
         
     # Remove NaN rows
     if remove_nan_rows==True:
-        a_no_nan_ind,=np.where(~np.isnan(timeseries_a))
-        timeseries_a=timeseries_a[a_no_nan_ind]
-        timeseries_b=timeseries_b[a_no_nan_ind]
-
-        b_no_nan_ind,=np.where(~np.isnan(timeseries_b))
-        timeseries_a=timeseries_a[b_no_nan_ind]
-        timeseries_b=timeseries_b[b_no_nan_ind]
+        no_nan_mask=~(np.isnan(timeseries_a) | np.isnan(timeseries_b))
+        timeseries_a=timeseries_a[no_nan_mask]
+        timeseries_b=timeseries_b[no_nan_mask]
         
     # Lag the data, preparing it for MI
     timeseries_a, lagged_timeseries_b, lags=lag_data(timeseries_a, timeseries_b, temporal_resolution=temporal_resolution, max_lag=max_lag, min_lag=min_lag)
+    # Float copy of the lags for the curve fitting
+    lags_f=lags.astype(np.float64)
+
+    # Choose the MI estimator once from all the lags, so the surrogate MI
+    #   below, which may use only one lag, uses the same estimator
+    estimator=resolve_estimator(lagged_timeseries_b, timeseries_a, estimator)
+
+    # Bin b on the range of all the lags, so a surrogate MI using only one
+    #   lag is binned the same as the MI
+    b_range=None
+    if estimator=='histogram':
+        span_b=lagged_span(lagged_timeseries_b)
+        b_range=(np.min(span_b), np.max(span_b))
     
     # Calculate the MI between a and b, with b at various lags
     print('Calculating MI between a and b, slow, started at: ',dt.datetime.now())
-    mutual_information=mutual_info_regression(lagged_timeseries_b,timeseries_a, random_state=0)
-
-    # Generate a random phase surrogate for timeseries a
-    print('Generating a random phase surrogate of timeseries a')
-    RPS_timeseries_a=aaft.AAFTsur(timeseries_a)
-    # Calculate MI between RPS of a and b, with b at various lags
-    print('Calculating MI between RPS a and b, slow, started at: ',dt.datetime.now())
-    RPS_mutual_information=mutual_info_regression(lagged_timeseries_b,RPS_timeseries_a, random_state=0)
+    mutual_information=mi_across_lags(lagged_timeseries_b, timeseries_a, n_jobs=n_jobs, estimator=estimator, b_range=b_range)
+
+    if (check_surrogate==True) | (n_surrogates is None):
+        # Generate a random phase surrogate for timeseries a
+        print('Generating a random phase surrogate of timeseries a')
+        RPS_timeseries_a=aaft.AAFTsur(timeseries_a)
+        # Calculate MI between RPS of a and b, with b at various lags
+        print('Calculating MI between RPS a and b, slow, started at: ',dt.datetime.now())
+        RPS_mutual_information=mi_across_lags(lagged_timeseries_b, RPS_timeseries_a, n_jobs=n_jobs, estimator=estimator, b_range=b_range)
+    else:
+        # A random phase surrogate has no coupling to b at any lag, so
+        #   only the mean surrogate MI is needed. Estimate it from several
+        #   surrogates of a at the lag closest to zero, spread over threads.
+        #   The surrogates themselves are generated in this thread
+        print('Calculating MI between b and',n_surrogates,'RPS of a at lag ~0, started at: ',dt.datetime.now())
+        zero_i=np.abs(lags).argmin()
+        RPS_mis=Parallel(n_jobs=n_jobs, prefer="threads")(
+            delayed(mi_across_lags)(lagged_timeseries_b[:,zero_i:zero_i+1], aaft.AAFTsur(timeseries_a), n_jobs=1, estimator=estimator, b_range=b_range)
+            for i in range(n_surrogates))
+        RPS_mutual_information=np.full(lags.size, np.mean(RPS_mis))
 
 
     if no_plot==False:
@@ -273,11 +804,28 @@ def mi_lag_finder(timeseries_a, timeseries_b, temporal_resolution=1, max_lag=60,
                 annotation_clip=False,arrowprops=dict(width=1.0,
                 headwidth=10.0, color="dodgerblue"), color="dodgerblue", ha='left', va='center', xycoords='axes fraction', fontsize=csize)
 
-    # Fit an x squared curve
+    # Define an x squared curve and a linear piecewise curve
     def x_squared(x,a,b,c):
         return -a*((x+b)**2)+c
-    popt,pcov=curve_fit(x_squared,lags,mutual_information)
-    xsq_modeli=x_squared(lags, *popt)
+    def piecewise_linear(x, x0, y0, k1, k2):
+        return np.where(x < x0, k1*(x-x0) + y0, k2*(x-x0) + y0)
+
+    # Initial guess for the x squared fit, from the MI peak, with the
+    #   curvature which drops from the peak to the minimum MI across the lags
+    peak_i=mutual_information.argmax()
+    p0_x_squared=[(mutual_information[peak_i]-mutual_information.min())/np.max((lags_f-lags_f[peak_i])**2),
+                  -lags_f[peak_i], mutual_information[peak_i]]
+
+    # Fit both curves. The fits are independent, so they are run in two
+    #   threads. Plotting must stay in this thread
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+        x_squared_fit=pool.submit(curve_fit,x_squared,lags_f,mutual_information,p0=p0_x_squared)
+        piecewise_fit=pool.submit(curve_fit,piecewise_linear,lags_f,mutual_information)
+        popt,pcov=x_squared_fit.result()
+        popt_lin,pcov_lin=piecewise_fit.result()
+
+    # Evaluate the x squared fit
+    xsq_modeli=x_squared(lags_f, *popt)
     xsq_tpeak=lags[xsq_modeli.argmax()]
     xsq_ipeak=xsq_modeli.max()
     
@@ -286,12 +834,7 @@ def mi_lag_finder(timeseries_a, timeseries_b, temporal_resolution=1, max_lag=60,
         ax.plot(lags, xsq_modeli, color="#98823c", label='$x^2$')
         ax.axvline(x=xsq_tpeak,color="#98823c",linewidth=1.0,linestyle='dashed', label='lag='+str(xsq_tpeak))
     
-    lower_interval=[]
-    upper_interval=[]
-    for i in xsq_modeli:
-        lower,prediction,upper = get_prediction_interval(i, mutual_information, xsq_modeli, pi=0.80)
-        lower_interval.append(lower)
-        upper_interval.append(upper)
+    lower_interval,_,upper_interval = get_prediction_interval(xsq_modeli, mutual_information, xsq_modeli, pi=0.80)
         
     if no_plot==False:
         # Plot the 80% confidence interval
@@ -303,11 +846,8 @@ def mi_lag_finder(timeseries_a, timeseries_b, temporal_resolution=1, max_lag=60,
                                 'RMS':np.mean((mutual_information-xsq_modeli)**2)
                                 }, index=[0])
 
-    # Fit a linear piecewise curve
-    def piecewise_linear(x, x0, y0, k1, k2):
-        return np.piecewise(x, [x < x0, x >= x0], [lambda x:k1*x + y0-k1*x0, lambda x:k2*x + y0-k2*x0])
-    popt_lin,pcov_lin=curve_fit(piecewise_linear,lags,mutual_information)
-    xlin_modeli=piecewise_linear(lags.astype(float), *popt_lin)
+    # Evaluate the linear piecewise fit
+    xlin_modeli=piecewise_linear(lags_f, *popt_lin)
     xlin_tpeak=lags[xlin_modeli.argmax()]
     xlin_ipeak=xlin_modeli.max()
     
@@ -316,12 +856,7 @@ def mi_lag_finder(timeseries_a, timeseries_b, temporal_resolution=1, max_lag=60,
         ax.plot(lags, xlin_modeli, color="#9a5ea1", label='pw')
         ax.axvline(x=xlin_tpeak,color="#9a5ea1",linewidth=1.0,linestyle='dashed', label='lag='+str(xlin_tpeak))
     
-    lower_interval=[]
-    upper_interval=[]
-    for i in xlin_modeli:
-        lower,prediction,upper = get_prediction_interval(i, mutual_information, xlin_modeli, pi=0.80)
-        lower_interval.append(lower)
-        upper_interval.append(upper)
+    lower_interval,_,upper_interval = get_prediction_interval(xlin_modeli, mutual_information, xlin_modeli, pi=0.80)
        
     if no_plot==False:
         # Plot the 80% confidence interval
@@ -355,12 +890,12 @@ def get_prediction_interval(prediction, y_test, test_predictions, pi=.95):
     Get a prediction interval for a linear regression.
     From: https://medium.com/swlh/ds001-linear-regression-and-confidence-interval-a-hands-on-tutorial-760658632d99
     INPUTS:
-    - Single prediction,
+    - Single prediction, or array of predictions
     - y_test
     - All test set predictions,
     - Prediction interval threshold (default = .95)
     OUTPUT:
-    - Prediction interval for single prediction
+    - Prediction interval for the prediction(s)
     '''
     #get standard deviation of y_test
     sum_errs = np.sum((y_test - test_predictions)**2)